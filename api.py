@@ -2,23 +2,33 @@
 """api.py - endpoints for the blackjack application."""
 
 
+import logging
+
 import endpoints
 from protorpc import remote, messages
 from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
 
-from models import User, Game, Score
+from models import User, Game, Score, MoveRecord, Table, Seat, ActiveGames
 from models import (
     StringMessage,
     StringMessages,
     NewGameForm,
+    NewTableForm,
+    TableForm,
+    SeatForm,
     GameForm,
     MakeMoveForm,
+    ScoreForm,
     ScoreForms,
     GameForms,
     EventForms
 )
-from utils import get_by_urlsafe
+from utils import get_by_urlsafe, get_key_by_urlsafe, enqueue_coalesced
+from utils import parse_fields
+import throttle
+from profiler import profiled
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -28,8 +38,51 @@ MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+# Listing and read endpoints take an optional comma separated fields mask.
+READ_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    fields=messages.StringField(2))
+USER_LIST_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    fields=messages.StringField(2))
+SCORES_REQUEST = endpoints.ResourceContainer(fields=messages.StringField(1))
+NEW_TABLE_REQUEST = endpoints.ResourceContainer(NewTableForm)
+GET_TABLE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_table_key=messages.StringField(1),)
+SEAT_MOVE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_seat_key=messages.StringField(1),
+    move=messages.StringField(2, required=True))
 
 MEMCACHE_WINRATE = 'WINRATE'
+# The average winrate is recomputed at most once per this many seconds.
+WINRATE_REFRESH_WINDOW = 60
+MEMCACHE_GAME_ETAG = 'GAME_ETAG:{}'
+# Bounds how long a lost update could leave a stale tag for a live game.
+# Tags of finished games never change and are cached without expiry.
+LIVE_ETAG_TIME = 60
+
+SEAT_RESULT_MESSAGES = {
+    'P_BUST': 'You busted! You lose!',
+    'D_BUST': 'The Dealer busted! You win!',
+    'P_BLK_JK': 'You win with a blackjack!',
+    'D_BLK_JK': 'The dealer got a blackjack! You lose!',
+    'P_WIN': 'You have a higher value than the dealer! You win!',
+    'D_WIN': 'The dealer has a higher value than you! You lose!',
+    'TIE': 'You tied with the Dealer!',
+}
+
+# GameForm fields that a user's ActiveGames index can fill without reading
+# the games.
+GAME_KEY_FIELDS = frozenset(['urlsafe_key', 'user_name', 'game_over'])
+# The Score property backing each ScoreForm field, for projection queries.
+SCORE_FIELD_PROPERTIES = {'user_name': Score.user, 'date': Score.date,
+                          'won': Score.won, 'tied': Score.tied}
+
+
+class TooManyRequestsException(endpoints.ForbiddenException):
+    """The caller has used up its request budget for the endpoint. Endpoints
+       turns statuses it does not support, such as 429, into 404, so this is
+       sent as a 403 with its own message."""
 
 
 @endpoints.api(name='blackjack', version='v1')
@@ -40,6 +93,7 @@ class BlackjackApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @profiled
     def create_user(self, request):
         """Create a User. Requires a unique username"""
         if User.query(User.name == request.user_name).get():
@@ -55,34 +109,48 @@ class BlackjackApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @profiled
     def new_game(self, request):
         """Creates new game"""
+        self._throttle('new_game', request.user_name)
         user = User.query(User.name == request.user_name).get()
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
         game = Game.new_game(user.key)
+        self._cache_etag(game, memcache.set)
         message = 'Good luck playing blackjack! Your hand is'
         for card in game.player_cards:
             message += ' ' + card
         message += '. Dealer hand is ' + game.dealer_cards[0] + '.'
 
-        # Use a task queue to update the average attempts remaining.
+        # Use a task queue to update the average winrate.
         # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_winrate')
+        # so it is performed out of sequence, and coalesced with every other
+        # request in the same window.
+        enqueue_coalesced('/tasks/cache_average_winrate',
+                          WINRATE_REFRESH_WINDOW)
         return game.to_form(message)
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=READ_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @profiled
     def get_game(self, request):
-        """Return the current game state."""
+        """Return the current game state. If the If-None-Match header holds
+        the game's current etag, only urlsafe_key, etag and not_modified are
+        returned."""
+        fields = parse_fields(request.fields, GameForm)
+        etag = self._cached_etag_match(request.urlsafe_game_key)
+        if etag:
+            return GameForm(urlsafe_key=request.urlsafe_game_key, etag=etag,
+                            not_modified=True)
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
-            return game.to_form('Time to make a move! HIT or STAND?')
+            self._cache_etag(game, memcache.add)
+            return game.to_form('Time to make a move! HIT or STAND?', fields)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
@@ -91,12 +159,15 @@ class BlackjackApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @profiled
     def cancel_game(self, request):
         """Delete the requested game."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
-            if not game.game_over:
-                game.key.delete()
+            # cancel checks game_over again inside its transaction, as a
+            # move may end the game after this read.
+            if not game.game_over and game.cancel():
+                memcache.delete(MEMCACHE_GAME_ETAG.format(game.key.urlsafe()))
                 return StringMessage(message="Game with key: %s deleted."
                                      % request.urlsafe_game_key)
             else:
@@ -109,98 +180,167 @@ class BlackjackApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @profiled
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            if game.game_over:
-                raise endpoints.ForbiddenException('Game is already over.')
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        self._throttle('make_move', game_key.urlsafe())
+        etag_key = MEMCACHE_GAME_ETAG.format(game_key.urlsafe())
+        # Drop the cached tag first so no reader can answer not modified for
+        # the old state once the move is committed.
+        memcache.delete(etag_key)
+        try:
+            form, replayed = ndb.transaction(
+                lambda: self._make_move_txn(game_key, request), xg=True)
+        except datastore_errors.TransactionFailedError:
+            raise endpoints.ConflictException(
+                'The game is being updated by another request, try again.')
+        if not replayed:
+            # A replayed response may describe an older state of the game.
+            memcache.set(etag_key, form.etag,
+                         time=0 if form.game_over else LIVE_ETAG_TIME)
+        return form
+
+    @staticmethod
+    def _make_move_txn(game_key, request):
+        """Applies a move inside a transaction. A request with a version that
+           no longer matches the game is rejected, and a request whose
+           idempotency_key has already been seen returns the stored response
+           without applying the move again.
+           Returns the GameForm and whether it is a stored response."""
+        if request.idempotency_key:
+            record = MoveRecord.get_by_id(request.idempotency_key,
+                                          parent=game_key)
+            if record:
+                return record.to_form(), True
 
-            if game.player_val == 21 and len(game.player_cards) == 2:
-                # player has a blackjack,
-                # checking if the dealer has a blackjack.
-                game.reveal()
-                if game.dealer_val == 21 and len(game.dealer_cards) == 2:
-                    game.append_history('TIE')
-                    game.end_game(True, True)
-                    return game.to_form("You tied with the Dealer!")
-                else:
-                    game.append_history('P_BLK_JK')
-                    game.end_game(True)
-                    return game.to_form("You win with a blackjack!")
-
-            if request.move.lower() == 'hit':
-                if game.hit('P'):
-                    message = 'Your hand is'
-                    for card in game.player_cards:
-                        message += ' ' + card
-                    return game.to_form(message)
-                else:
-                    game.append_history('P_BUST')
-                    game.end_game()
-                    message = 'You busted with a value of ' +\
-                              str(game.player_val)
-                    return game.to_form(message)
-
-            elif request.move.lower() == 'stand':
-                result = game.stand()
-                # result key:
-                # 0 if the dealer won
-                # 1 if the dealer won by blackjack
-                # 2 if a tie
-                # 3 if the dealer busted
-                # 4 if the player won by value.
-                if result == 0:
-                    game.end_game()
-                    return game.to_form("The dealer has a higher value than "
-                                        "you! You lose!")
-                elif result == 1:
-                    game.end_game()
-                    return game.to_form("The dealer got a blackjack!"
-                                        " You lose!")
-                elif result == 2:
-                    game.end_game(True, True)
-                    return game.to_form("You tied with the Dealer!")
-                elif result == 3:
-                    game.end_game(True)
-                    return game.to_form("The Dealer busted! You win!")
-                elif result == 4:
-                    game.end_game(True)
-                    return game.to_form("You have a higher value than the "
-                                        "dealer! You win!")
-                else:
-                    game.to_form("Unknown error: " + str(result))
+        game = game_key.get()
+        if not game:
+            raise endpoints.NotFoundException("Game not found!")
+        if request.version is not None and request.version != game.version:
+            raise endpoints.ConflictException(
+                'The game has changed since version {}.'.format(
+                    request.version))
+        if game.game_over:
+            raise endpoints.ForbiddenException('Game is already over.')
+
+        events = len(game.history)
+        message = BlackjackApi._apply_move(game, request.move)
+        if len(game.history) != events:
+            game.touch()
+            game.put()
+        form = game.to_form(message)
+        if request.idempotency_key:
+            MoveRecord.record(game_key, request.idempotency_key, form)
+        return form, False
+
+    @staticmethod
+    def _apply_move(game, move):
+        """Applies a move to the game and returns the message for the
+           player."""
+        if game.player_val == 21 and len(game.player_cards) == 2:
+            # player has a blackjack,
+            # checking if the dealer has a blackjack.
+            game.reveal()
+            if game.dealer_val == 21 and len(game.dealer_cards) == 2:
+                game.append_history('TIE')
+                game.end_game(True, True)
+                return "You tied with the Dealer!"
             else:
-                return game.to_form('Please enter either HIT or STAND.')
+                game.append_history('P_BLK_JK')
+                game.end_game(True)
+                return "You win with a blackjack!"
+
+        if move.lower() == 'hit':
+            if game.hit('P'):
+                message = 'Your hand is'
+                for card in game.player_cards:
+                    message += ' ' + card
+                return message
+            else:
+                game.append_history('P_BUST')
+                game.end_game()
+                return 'You busted with a value of ' + str(game.player_val)
+
+        elif move.lower() == 'stand':
+            result = game.stand()
+            # result key:
+            # 0 if the dealer won
+            # 1 if the dealer won by blackjack
+            # 2 if a tie
+            # 3 if the dealer busted
+            # 4 if the player won by value.
+            if result == 0:
+                game.end_game()
+                return "The dealer has a higher value than you! You lose!"
+            elif result == 1:
+                game.end_game()
+                return "The dealer got a blackjack! You lose!"
+            elif result == 2:
+                game.end_game(True, True)
+                return "You tied with the Dealer!"
+            elif result == 3:
+                game.end_game(True)
+                return "The Dealer busted! You win!"
+            elif result == 4:
+                game.end_game(True)
+                return "You have a higher value than the dealer! You win!"
+            else:
+                return "Unknown error: " + str(result)
         else:
-            raise endpoints.NotFoundException("Game not found!")
+            return 'Please enter either HIT or STAND.'
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=SCORES_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @profiled
     def get_scores(self, request):
         """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        fields = parse_fields(request.fields, ScoreForm)
+        query = Score.query()
+        if fields is not None and len(fields) == 1:
+            # A single property projection is served by the built in index.
+            scores = query.fetch(
+                projection=[SCORE_FIELD_PROPERTIES[name] for name in fields])
+        else:
+            scores = query.fetch()
+        names = {}
+        if fields is None or 'user_name' in fields:
+            # One batch get of the distinct users instead of one per Score.
+            names = dict((user.key, user.name) for user in ndb.get_multi(
+                list(set(score.user for score in scores))) if user)
+        return ScoreForms(items=[score.to_form(fields, names.get(score.user))
+                                 for score in scores])
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_LIST_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @profiled
     def get_user_scores(self, request):
         """Returns all of an individual User's scores"""
+        fields = parse_fields(request.fields, ScoreForm)
         user = User.query(User.name == request.user_name).get()
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        query = Score.query(Score.user == user.key)
+        if fields is not None and fields <= frozenset(['user_name']):
+            # Nothing beyond the user is wanted, so the keys are enough.
+            return ScoreForms(items=[
+                ScoreForm(user_name=user.name if fields else None)
+                for key in query.iter(keys_only=True)])
+        return ScoreForms(items=[score.to_form(fields, user.name)
+                                 for score in query])
 
     @endpoints.method(response_message=StringMessages,
                       path='scores/ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @profiled
     def get_user_rankings(self, request):
         """Returns all users ranked by performance."""
         users = User.query().fetch()
@@ -224,38 +364,222 @@ class BlackjackApi(remote.Service):
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @profiled
     def get_game_history(self, request):
-        """Returns the requested game's move history"""
+        """Returns the requested game's move history. If the If-None-Match
+        header holds the game's current etag, only etag and not_modified are
+        returned."""
+        etag = self._cached_etag_match(request.urlsafe_game_key)
+        if etag:
+            return EventForms(etag=etag, not_modified=True)
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
+            self._cache_etag(game, memcache.add)
             history = game.get_history()
         else:
             raise endpoints.NotFoundException("Game not found!")
         return history
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_LIST_REQUEST,
                       response_message=GameForms,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @profiled
     def get_user_games(self, request):
-        """Returns all of an individual User's active games"""
+        """Returns all of an individual User's active games. A fields mask
+        within urlsafe_key, user_name and game_over is answered from the
+        index alone, without checking that each game still exists and is
+        unfinished; wider masks skip games that are gone or finished."""
+        fields = parse_fields(request.fields, GameForm)
         user = User.query(User.name == request.user_name).get()
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not Exist!')
-        games = Game.query(Game.user == user.key)\
-                    .filter(Game.game_over == False)
-        return GameForms(items=[game.to_form('') for game in games])
+        index = ActiveGames.key_for(user.key).get()
+        if index:
+            game_keys = index.games
+        else:
+            # Users not yet indexed by the rebuild job fall back to the query.
+            game_keys = Game.query(Game.user == user.key)\
+                            .filter(Game.game_over == False)\
+                            .fetch(keys_only=True)
+        if fields is not None and fields <= GAME_KEY_FIELDS:
+            # Everything asked for is known from the index itself. The keys
+            # are not checked against the games, so a drifted entry is listed
+            # until the rebuild job repairs it.
+            return GameForms(items=[
+                GameForm(urlsafe_key=key.urlsafe(),
+                         user_name=user.name if 'user_name' in fields
+                         else None,
+                         game_over=False if 'game_over' in fields else None)
+                for key in game_keys])
+        # Games the index has drifted from are skipped until the rebuild job
+        # repairs it.
+        games = [game for game in ndb.get_multi(game_keys)
+                 if game and not game.game_over]
+        return GameForms(items=[game.to_form('', fields, user.name)
+                                for game in games])
+
+    @endpoints.method(request_message=NEW_TABLE_REQUEST,
+                      response_message=TableForm,
+                      path='table',
+                      name='new_table',
+                      http_method='POST')
+    @profiled
+    def new_table(self, request):
+        """Creates a new table with a seat for each user name"""
+        if not 0 < len(request.user_names) <= Table.MAX_SEATS:
+            raise endpoints.BadRequestException(
+                'A table seats between 1 and {} players.'.format(
+                    Table.MAX_SEATS))
+        for user_name in set(request.user_names):
+            self._throttle('new_game', user_name)
+        user_keys = {}
+        for user_name in set(request.user_names):
+            user = User.query(User.name == user_name).get()
+            if not user:
+                raise endpoints.NotFoundException(
+                    'A User named {} does not exist!'.format(user_name))
+            user_keys[user_name] = user.key
+        table, seats = Table.new_table([user_keys[user_name] for user_name
+                                        in request.user_names])
+        # Every seat may have been dealt a blackjack.
+        if self._resolve_round(table.key):
+            table, seats = table.key.get(), ndb.get_multi(table.seats)
+        return table.to_form(seats, dict((key, user_name) for user_name, key
+                                         in user_keys.items()))
+
+    @endpoints.method(request_message=GET_TABLE_REQUEST,
+                      response_message=TableForm,
+                      path='table/{urlsafe_table_key}',
+                      name='get_table',
+                      http_method='GET')
+    @profiled
+    def get_table(self, request):
+        """Return the current state of a table and all its seats."""
+        table = get_by_urlsafe(request.urlsafe_table_key, Table)
+        if not table:
+            raise endpoints.NotFoundException('Table not found!')
+        seats = ndb.get_multi(table.seats)
+        # Settle a round whose resolve failed after the last seat finished.
+        if not table.round_over and all(seat.done for seat in seats) and \
+                self._resolve_round(table.key):
+            table, seats = table.key.get(), ndb.get_multi(table.seats)
+        users = ndb.get_multi(list(set(seat.user for seat in seats)))
+        return table.to_form(seats, dict((user.key, user.name)
+                                         for user in users))
+
+    @endpoints.method(request_message=SEAT_MOVE_REQUEST,
+                      response_message=SeatForm,
+                      path='table/seat/{urlsafe_seat_key}',
+                      name='make_seat_move',
+                      http_method='PUT')
+    @profiled
+    def make_seat_move(self, request):
+        """Makes a move for one seat at a table. Once every seat is done the
+        dealer plays and the seat's result is returned."""
+        seat_key = get_key_by_urlsafe(request.urlsafe_seat_key, Seat)
+        self._throttle('make_move', seat_key.urlsafe())
+        seat = seat_key.get()
+        if not seat:
+            raise endpoints.NotFoundException('Seat not found!')
+        # The shoe never changes once dealt, so it is read outside the
+        # transaction to keep the Table out of the seat's entity groups.
+        table = seat.table.get()
+        if seat.done and not table.round_over:
+            # The seat finished but its round was never resolved; retry it.
+            if self._resolve_round(table.key):
+                seat = seat_key.get()
+                return seat.to_form(SEAT_RESULT_MESSAGES[seat.result])
+        shoe = table.shoe
+        try:
+            seat, message = ndb.transaction(
+                lambda: self._seat_move_txn(seat_key, shoe, request.move),
+                xg=True)
+        except datastore_errors.TransactionFailedError:
+            raise endpoints.ConflictException(
+                'The seat is being updated by another request, try again.')
+        if seat.done and self._resolve_round(seat.table):
+            seat = seat_key.get()
+            message = SEAT_RESULT_MESSAGES[seat.result]
+        return seat.to_form(message)
+
+    @staticmethod
+    def _seat_move_txn(seat_key, shoe, move):
+        """Applies a hit or stand to a seat. Only the Seat and, when the seat
+           needs a new block of cards, the table's ShoePosition are written.
+           Returns the seat and the message for the player."""
+        seat = seat_key.get()
+        if seat.done:
+            raise endpoints.ForbiddenException('Seat has already finished.')
+        if move.lower() == 'hit':
+            if seat.hit(shoe):
+                message = 'Your hand is ' + ' '.join(seat.player_cards)
+            else:
+                message = 'You busted with a value of ' + str(seat.player_val)
+        elif move.lower() == 'stand':
+            seat.stand()
+            message = 'You stand on {}. Waiting for the other seats.'.format(
+                seat.player_val)
+        else:
+            return seat, 'Please enter either HIT or STAND.'
+        seat.put()
+        return seat, message
+
+    @staticmethod
+    def _resolve_round(table_key):
+        """Resolves the table's round if every seat is done. Returns True if
+           this call resolved it. A failed resolve is logged and retried by
+           the next get_table or move on a finished seat."""
+        try:
+            return Table.resolve(table_key)
+        except datastore_errors.TransactionFailedError:
+            logging.warning('Could not resolve the round of table %s.',
+                            table_key.urlsafe())
+            return False
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_winrate',
                       name='get_average_winrate',
                       http_method='GET')
+    @profiled
     def get_average_winrate(self, request):
         """Get the cached average winrate"""
         return StringMessage(message=memcache.get(MEMCACHE_WINRATE) or '')
 
+    @staticmethod
+    def _throttle(endpoint, subject):
+        """Raises TooManyRequestsException, before any datastore access, if
+           subject has used up its request budget for endpoint."""
+        if not throttle.allow(endpoint, subject):
+            raise TooManyRequestsException(
+                'Too many {} requests, please slow down.'.format(endpoint))
+
+    def _cached_etag_match(self, urlsafe_game_key):
+        """Returns the request's If-None-Match etag if it matches the etag
+           cached for the game, without reading the datastore, else None.
+           Endpoints turns a 304 into a 404, so callers answer with a slim
+           form flagged not_modified instead. Tags of finished games are
+           cached without expiry; on a cache miss the caller falls through
+           to a normal read."""
+        headers = getattr(getattr(self, 'request_state', None), 'headers',
+                          None)
+        etag = headers and headers.get('If-None-Match')
+        if not etag:
+            return None
+        game_key = get_key_by_urlsafe(urlsafe_game_key, Game)
+        if memcache.get(MEMCACHE_GAME_ETAG.format(game_key.urlsafe())) == etag:
+            return etag
+        return None
+
+    @staticmethod
+    def _cache_etag(game, store):
+        """Caches the game's etag with store, either memcache.set or, for
+           readers that must not overwrite a newer tag, memcache.add."""
+        store(MEMCACHE_GAME_ETAG.format(game.key.urlsafe()), game.etag(),
+              time=0 if game.game_over else LIVE_ETAG_TIME)
+
     @staticmethod
     def _cache_average_winrate():
         """Populates memcache with the average winrate of Games"""
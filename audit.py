@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""audit.py - Batch integrity auditor for stored games.
+
+Replays every Game's history through the rules of the API and reports any
+game whose stored cards, values, outcome or Score disagree with it. A full
+run also checks each User's points and total_games against their Scores.
+
+Games are read in cursor paged batches over the remote API and replayed in a
+pool of worker processes while the next batch is being fetched. With
+--incremental only games that ended after the last checkpoint are checked,
+and the checkpoint is moved forward when the run completes.
+
+Example:
+    python audit.py --host my-app.appspot.com --incremental
+"""
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+from datetime import datetime
+from multiprocessing import Pool
+
+from utils import calc_val
+
+CHECKPOINT_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Outcome events and the (won, tied) pair end_game records for them.
+OUTCOMES = {
+    'P_BUST': (False, False),
+    'D_BUST': (True, False),
+    'P_BLK_JK': (True, False),
+    'D_BLK_JK': (False, False),
+    'P_WIN': (True, False),
+    'D_WIN': (False, False),
+    'TIE': (True, True),
+}
+
+
+def outcome_holds(outcome, player, dealer):
+    """Returns True if the outcome event is consistent with the hands"""
+    player_val = calc_val(player)
+    dealer_val = calc_val(dealer)
+    if outcome == 'P_BUST':
+        return player_val > 21
+    elif outcome == 'D_BUST':
+        return dealer_val > 21
+    elif outcome == 'P_BLK_JK':
+        return player_val == 21 and len(player) == 2
+    elif outcome == 'D_BLK_JK':
+        return dealer_val == 21 and len(dealer) == 2
+    elif outcome == 'P_WIN':
+        return dealer_val >= 17 and 21 >= player_val > dealer_val
+    elif outcome == 'D_WIN':
+        return 21 >= dealer_val > player_val
+    return player_val == dealer_val
+
+
+def replay(row):
+    """Replays one game. row is a tuple of the game's urlsafe key, history
+       events, game_over, player_cards, dealer_cards, player_val, dealer_val,
+       its Score as a (won, tied) pair or None, and whether a Score is
+       expected. Returns the urlsafe key and a list of problems found."""
+    (key, events, game_over, player_cards, dealer_cards, player_val,
+     dealer_val, score, expect_score) = row
+    problems = []
+    player, dealer, hidden, seen = [], [], None, set()
+    outcome, stood, ended = None, False, False
+
+    for event in events:
+        parts = event.split('.')
+        name = parts[0]
+        if name == 'START':
+            if len(parts) != 5 or seen:
+                problems.append('malformed START event')
+                continue
+            player, dealer, hidden = parts[1:3], [parts[3]], parts[4]
+            seen.update(parts[1:5])
+            if len(seen) != 4:
+                problems.append('duplicate card dealt at start')
+        elif name in ('P_HIT', 'D_HIT'):
+            card = parts[1]
+            if card in seen:
+                problems.append('card {} dealt twice'.format(card))
+            seen.add(card)
+            if outcome:
+                problems.append('{} after the outcome'.format(name))
+            if name == 'P_HIT':
+                if stood:
+                    problems.append('player hit after standing')
+                player.append(card)
+            else:
+                # The dealer only draws while behind the player and under 17.
+                if not (calc_val(dealer) < min(calc_val(player), 17)):
+                    problems.append('dealer hit on {}'.format(
+                        calc_val(dealer)))
+                dealer.append(card)
+        elif name == 'REVEAL':
+            if parts[1] != hidden:
+                problems.append('revealed {} but hidden card was {}'.format(
+                    parts[1], hidden))
+            dealer.append(parts[1])
+            hidden = None
+        elif name == 'STAND':
+            stood = True
+        elif name in OUTCOMES:
+            if outcome:
+                problems.append('second outcome {}'.format(name))
+            outcome = name
+            if not outcome_holds(name, player, dealer):
+                problems.append('{} does not match hands {} / {}'.format(
+                    name, ' '.join(player), ' '.join(dealer)))
+        elif name == 'GAME_OVER':
+            ended = True
+        else:
+            problems.append('unknown event {}'.format(name))
+
+    if player_cards != player:
+        problems.append('player_cards {} but history deals {}'.format(
+            ' '.join(player_cards), ' '.join(player)))
+    if dealer_cards != dealer:
+        problems.append('dealer_cards {} but history deals {}'.format(
+            ' '.join(dealer_cards), ' '.join(dealer)))
+    if player_val != calc_val(player):
+        problems.append('player_val {} but cards are worth {}'.format(
+            player_val, calc_val(player)))
+    if dealer_val != calc_val(dealer):
+        problems.append('dealer_val {} but cards are worth {}'.format(
+            dealer_val, calc_val(dealer)))
+    if game_over != ended:
+        problems.append('game_over is {} but history {} GAME_OVER'.format(
+            game_over, 'has' if ended else 'lacks'))
+    if ended and not outcome:
+        problems.append('game ended without an outcome')
+    if score is None:
+        if expect_score and game_over:
+            problems.append('no Score recorded')
+    elif not outcome:
+        problems.append('Score recorded for an unfinished game')
+    elif tuple(score) != OUTCOMES[outcome]:
+        problems.append('Score won/tied {} but outcome is {}'.format(
+            tuple(score), outcome))
+    return key, problems
+
+
+def game_rows(games):
+    """Turns a batch of Games into picklable rows for replay"""
+    from google.appengine.ext import ndb
+    from models import Score
+    scores = ndb.get_multi([Score.key_for(game.key) for game in games])
+    return [(game.key.urlsafe(), list(game.events()), game.game_over,
+             list(game.player_cards), list(game.dealer_cards),
+             game.player_val, game.dealer_val,
+             (score.won, score.tied) if score else None,
+             # Games that ended before Scores were keyed by game have none.
+             game.ended is not None)
+            for game, score in zip(games, scores)]
+
+
+def audit_games(pool, since, batch_size):
+    """Replays every game (or every game ended after since) and yields
+       (urlsafe key, problems). The last item yielded is the latest ended
+       time seen, as (None, datetime)."""
+    from models import Game
+    if since:
+        query = Game.query(Game.ended > since).order(Game.ended)
+    else:
+        query = Game.query()
+    latest = since
+    future = query.fetch_page_async(batch_size, batch_size=batch_size)
+    while future:
+        games, cursor, more = future.get_result()
+        # Fetch the next page while this one is replayed.
+        future = more and query.fetch_page_async(
+            batch_size, start_cursor=cursor, batch_size=batch_size)
+        for game in games:
+            if game.ended and (latest is None or game.ended > latest):
+                latest = game.ended
+        for result in pool.imap_unordered(replay, game_rows(games)):
+            yield result
+    yield None, latest
+
+
+def audit_users(batch_size):
+    """Checks every User's points and total_games against their Scores and
+       yields (user name, problem) for each mismatch."""
+    from models import User, Score
+    points = defaultdict(int)
+    totals = defaultdict(int)
+    for score in Score.query().iter(batch_size=batch_size):
+        totals[score.user] += 1
+        points[score.user] += 1 if score.tied else 2 if score.won else 0
+    for user in User.query().iter(batch_size=batch_size):
+        if user.points != points[user.key]:
+            yield user.name, 'points {} but Scores add up to {}'.format(
+                user.points, points[user.key])
+        if user.total_games != totals[user.key]:
+            yield user.name, 'total_games {} but has {} Scores'.format(
+                user.total_games, totals[user.key])
+
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return datetime.strptime(json.load(f)['ended'], CHECKPOINT_FORMAT)
+
+
+def write_checkpoint(path, ended):
+    with open(path, 'w') as f:
+        json.dump({'ended': ended.strftime(CHECKPOINT_FORMAT)}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', required=True,
+                        help='host serving /_ah/remote_api, e.g. '
+                        'localhost:8080 or my-app.appspot.com')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only audit games ended since the checkpoint')
+    parser.add_argument('--checkpoint', default='audit_checkpoint.json')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='replay processes, defaults to the CPU count')
+    args = parser.parse_args()
+
+    # Start the workers before the remote API is configured; they only
+    # replay plain tuples and never talk to the datastore.
+    pool = Pool(args.processes)
+
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(args.host, '/_ah/remote_api')
+
+    since = read_checkpoint(args.checkpoint) if args.incremental else None
+    checked = flagged = 0
+    latest = since
+    for key, problems in audit_games(pool, since, args.batch_size):
+        if key is None:
+            latest = problems
+            continue
+        checked += 1
+        if problems:
+            flagged += 1
+            for problem in problems:
+                print 'game {}: {}'.format(key, problem)
+    pool.close()
+
+    if not args.incremental:
+        for name, problem in audit_users(args.batch_size):
+            flagged += 1
+            print 'user {}: {}'.format(name, problem)
+
+    if latest:
+        write_checkpoint(args.checkpoint, latest)
+    print 'Checked {} games, {} problems flagged.'.format(checked, flagged)
+    return 1 if flagged else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+"""loadtest.py - Concurrent load generator for the blackjack API.
+
+Simulates players that each create a User and then play full games through
+new_game and make_move, with periodic calls to the listing and ranking
+endpoints, and reports throughput, p50/p95/p99 latency and errors per
+endpoint.
+
+Two targets are supported:
+ - In process (default): BlackjackApi is called directly against the App
+   Engine testbed stubs. Needs the App Engine SDK on the python path.
+ - HTTP: pass --url with the API root of a running dev_appserver, e.g.
+   http://localhost:8080/_ah/api/blackjack/v1
+
+Example:
+    python loadtest.py --players 2000 --workers 64 --games 3
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import urllib
+import urllib2
+from collections import defaultdict
+from Queue import Queue, Empty
+
+
+class InProcessClient(object):
+    """Calls BlackjackApi methods directly against the testbed stubs"""
+    def __init__(self, hr_probability):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=hr_probability)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.testbed.init_app_identity_stub()
+
+        # The first import of the API is what a new instance pays for.
+        start = time.time()
+        import api
+        self.cold_start = time.time() - start
+        self.api = api
+        self.requests = {
+            'create_user': api.USER_REQUEST,
+            'new_game': api.NEW_GAME_REQUEST,
+            'make_move': api.MAKE_MOVE_REQUEST,
+            'get_game': api.READ_GAME_REQUEST,
+            'get_user_games': api.USER_LIST_REQUEST,
+            'get_user_rankings': None,
+        }
+
+    def call(self, name, **fields):
+        """Invokes an endpoint and returns its response as a dict"""
+        from protorpc import message_types
+        container = self.requests[name]
+        if container is None:
+            request = message_types.VoidMessage()
+        else:
+            request = container.combined_message_class(**fields)
+        service = self.api.BlackjackApi()
+        response = getattr(service, name)(request)
+        return dict((field.name, getattr(response, field.name))
+                    for field in response.all_fields())
+
+    def close(self):
+        self.testbed.deactivate()
+
+
+class HttpClient(object):
+    """Calls the API of a running dev_appserver over HTTP"""
+    ROUTES = {
+        'create_user': ('POST', 'user', ()),
+        'new_game': ('POST', 'game', ('user_name',)),
+        'make_move': ('PUT', 'game/{urlsafe_game_key}',
+                      ('move', 'version', 'idempotency_key')),
+        'get_game': ('GET', 'game/{urlsafe_game_key}', ()),
+        'get_user_games': ('GET', 'games/user/{user_name}', ()),
+        'get_user_rankings': ('GET', 'scores/ranking', ()),
+    }
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        start = time.time()
+        urllib2.urlopen(self.url + '/scores/ranking').read()
+        # Only a cold start if the server was started just before the run.
+        self.cold_start = time.time() - start
+
+    def call(self, name, **fields):
+        """Invokes an endpoint and returns its decoded JSON response"""
+        method, path, body_fields = self.ROUTES[name]
+        path = path.format(**fields)
+        body = dict((key, fields.pop(key)) for key in body_fields
+                    if fields.get(key) is not None)
+        query = dict((key, value) for key, value in fields.items()
+                     if value is not None and
+                     '{' + key + '}' not in self.ROUTES[name][1])
+        url = '{}/{}'.format(self.url, path)
+        if query:
+            url += '?' + urllib.urlencode(query)
+        request = urllib2.Request(url, json.dumps(body) if body else None,
+                                  {'Content-Type': 'application/json'})
+        request.get_method = lambda: method
+        try:
+            return json.loads(urllib2.urlopen(request).read() or '{}')
+        except urllib2.HTTPError, e:
+            raise HttpError(e.code)
+
+    def close(self):
+        pass
+
+
+class HttpError(Exception):
+    """An endpoint answered with an HTTP error status"""
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+    def __str__(self):
+        return 'HTTP {}'.format(self.code)
+
+
+class Stats(object):
+    """Thread safe latency and error recorder"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def timed(self, client, name, **fields):
+        """Calls the endpoint, records the outcome and returns the response,
+           or None if the call failed."""
+        start = time.time()
+        try:
+            response = client.call(name, **fields)
+        except Exception, e:
+            error = str(e) if isinstance(e, HttpError) else \
+                e.__class__.__name__
+            with self.lock:
+                self.latencies[name].append(time.time() - start)
+                self.errors[name][error] += 1
+            return None
+        with self.lock:
+            self.latencies[name].append(time.time() - start)
+        return response
+
+    def report(self, elapsed):
+        lines = ['{:<20}{:>8}{:>10}{:>9}{:>9}{:>9}{:>8}'.format(
+            'endpoint', 'calls', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+            'err %')]
+        total = 0
+        for name in sorted(self.latencies):
+            samples = sorted(self.latencies[name])
+            errors = sum(self.errors[name].values())
+            total += len(samples)
+            lines.append('{:<20}{:>8}{:>10.1f}{:>9.1f}{:>9.1f}{:>9.1f}'
+                         '{:>8.2f}'.format(
+                             name, len(samples), len(samples) / elapsed,
+                             percentile(samples, 50) * 1000,
+                             percentile(samples, 95) * 1000,
+                             percentile(samples, 99) * 1000,
+                             100.0 * errors / len(samples)))
+        lines.append('{} calls in {:.1f}s, {:.1f} req/s overall'.format(
+            total, elapsed, total / elapsed))
+        for name in sorted(self.errors):
+            for error, count in sorted(self.errors[name].items()):
+                lines.append('  {} {}: {}'.format(name, error, count))
+        return '\n'.join(lines)
+
+
+def percentile(samples, pct):
+    """Nearest rank percentile of sorted samples"""
+    if not samples:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(samples))) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+def play(client, stats, user_name, args):
+    """Runs one simulated player through its games"""
+    if stats.timed(client, 'create_user', user_name=user_name) is None:
+        return
+    for _ in range(args.games):
+        game = stats.timed(client, 'new_game', user_name=user_name)
+        if game is None:
+            continue
+        key = game['urlsafe_key']
+        while not game['game_over']:
+            # Dealer style strategy: hit below 17.
+            move = 'hit' if int(game['player_val']) < 17 else 'stand'
+            if random.random() < args.poll_rate:
+                stats.timed(client, 'get_game', urlsafe_game_key=key)
+            # JSON responses carry integers as strings.
+            version = int(game.get('version') or 0)
+            result = stats.timed(client, 'make_move', urlsafe_game_key=key,
+                                 move=move, version=version,
+                                 idempotency_key='move-{}'.format(version))
+            if result is None:
+                # Lost a race or failed; resync and carry on.
+                result = stats.timed(client, 'get_game',
+                                     urlsafe_game_key=key)
+                if result is None:
+                    break
+            game = result
+        if random.random() < args.listing_rate:
+            stats.timed(client, 'get_user_games', user_name=user_name)
+        if random.random() < args.ranking_rate:
+            stats.timed(client, 'get_user_rankings')
+
+
+def worker(client, stats, players, args):
+    while True:
+        try:
+            user_name = players.get_nowait()
+        except Empty:
+            return
+        play(client, stats, user_name, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=32,
+                        help='number of concurrent worker threads')
+    parser.add_argument('--games', type=int, default=2,
+                        help='games played by each player')
+    parser.add_argument('--poll-rate', type=float, default=0.2,
+                        help='chance of a get_game before each move')
+    parser.add_argument('--listing-rate', type=float, default=0.2,
+                        help='chance of a get_user_games after each game')
+    parser.add_argument('--ranking-rate', type=float, default=0.05,
+                        help='chance of a get_user_rankings after each game')
+    parser.add_argument('--hr-probability', type=float, default=1.0,
+                        help='testbed datastore consistency probability')
+    parser.add_argument('--url', help='API root of a running dev_appserver;'
+                        ' runs in process against testbed stubs if omitted')
+    args = parser.parse_args()
+
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        client = InProcessClient(args.hr_probability)
+    print 'Cold start (first API load): {:.1f} ms'.format(
+        client.cold_start * 1000)
+
+    run = int(time.time())
+    players = Queue()
+    for number in range(args.players):
+        players.put('load-{}-{}'.format(run, number))
+    stats = Stats()
+    threads = [threading.Thread(target=worker,
+                                args=(client, stats, players, args))
+               for _ in range(args.workers)]
+    start = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    client.close()
+    print stats.report(elapsed)
+
+
+if __name__ == '__main__':
+    main()
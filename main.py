@@ -2,44 +2,400 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
 import logging
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
 
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import BlackjackApi
+from google.appengine.ext import ndb
 
-from models import User, Game
+from models import User, Game, Score, MoveRecord, ActiveGames
+import utils
+
+# Games that have not been touched for this many days are deleted outright,
+# whether they were finished or abandoned. Can be overridden per run with the
+# ttl_days query parameter.
+GAME_TTL_DAYS = 30
+CLEANUP_BATCH_SIZE = 200
+# Pages a single cleanup or backfill task handles before continuing in a new
+# task.
+TASK_PAGES = 50
+CUTOFF_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+REMINDER_BATCH_SIZE = 100
+# Pages of users a single rebuild task handles. Each user costs a query, a
+# batch get and a transaction, so a task covers far fewer than TASK_PAGES.
+REBUILD_PAGES = 5
+# Games re-read in each ActiveGames rebuild transaction.
+REBUILD_TXN_GAMES = 24
+
+EXPORT_QUERIES = {'scores': Score.query, 'games': Game.query}
+EXPORT_PAGE_SIZE = 200
+# Caps how much a single export response holds. Clients resume from the
+# cursor returned in the X-Export-Cursor header.
+EXPORT_MAX_PAGES = 25
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
         """Send a reminder email to each User with an email about games.
         Called every hour using a cron job"""
+        from google.appengine.api import mail, app_identity
         app_id = app_identity.get_application_id()
         users = User.query(User.email != None)
-        for user in users:
-            games = Game.query(Game.user == user.key)\
-                        .filter(Game.game_over == False)
-            if games:
-                subject = 'This is your lucky day!'
-                body = 'Hello {}, you have unfinished' \
-                       ' blackjack games!'.format(user.name)
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+        cursor = None
+        more = True
+        while more:
+            page, cursor, more = users.fetch_page(REMINDER_BATCH_SIZE,
+                                                  start_cursor=cursor)
+            indexes = ndb.get_multi([ActiveGames.key_for(user.key)
+                                     for user in page])
+            for user, index in zip(page, indexes):
+                if index:
+                    active = bool(index.games)
+                else:
+                    # Not yet indexed by the rebuild job; query instead.
+                    active = Game.query(Game.user == user.key)\
+                                 .filter(Game.game_over == False)\
+                                 .get(keys_only=True) is not None
+                if active:
+                    self._send_reminder(mail, app_id, user)
+
+    @staticmethod
+    def _send_reminder(mail, app_id, user):
+        subject = 'This is your lucky day!'
+        body = 'Hello {}, you have unfinished' \
+               ' blackjack games!'.format(user.name)
+        # This will send test emails, the arguments to send_mail are:
+        # from, to, subject, body
+        mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                       user.email,
+                       subject,
+                       body)
 
 
 class UpdateAverageWinrate(webapp2.RequestHandler):
     def post(self):
         """Update game listing announcement in memcache."""
+        from api import BlackjackApi
         BlackjackApi._cache_average_winrate()
         self.response.set_status(204)
 
 
+class CleanupGames(webapp2.RequestHandler):
+    def get(self):
+        """Start a chain of tasks that expires inactive games and then
+        compacts finished ones. Called once a day using a cron job"""
+        from google.appengine.api import taskqueue
+        try:
+            ttl_days = int(self.request.get('ttl_days', GAME_TTL_DAYS))
+        except ValueError:
+            ttl_days = GAME_TTL_DAYS
+        cutoff = datetime.now() - timedelta(days=ttl_days)
+        taskqueue.add(url='/tasks/cleanup_games',
+                      params={'phase': 'expire',
+                              'cutoff': cutoff.strftime(CUTOFF_FORMAT)})
+        logging.info('Started cleanup of games older than %d days.',
+                     ttl_days)
+        self.response.set_status(204)
+
+    def post(self):
+        """Run at most TASK_PAGES pages of one cleanup phase and continue in
+        a new task from the cursor of the last. Expiry runs first so that
+        compaction does not spend time on games it is about to delete."""
+        from google.appengine.api import taskqueue
+        from google.appengine.datastore.datastore_query import Cursor
+        phase = self.request.get('phase')
+        cutoff = datetime.strptime(self.request.get('cutoff'), CUTOFF_FORMAT)
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+        if phase == 'expire':
+            count, cursor, more = self._expire_inactive(cutoff, cursor)
+        else:
+            # Games the next daily run will expire are not worth compacting.
+            count, cursor, more = self._compact_finished(
+                cutoff + timedelta(days=1), cursor)
+        logging.info('Cleanup %s step handled %d games.', phase, count)
+        params = {'phase': phase, 'cutoff': self.request.get('cutoff')}
+        if more and cursor:
+            params['cursor'] = cursor.urlsafe()
+            taskqueue.add(url='/tasks/cleanup_games', params=params)
+        elif phase == 'expire':
+            params['phase'] = 'compact'
+            taskqueue.add(url='/tasks/cleanup_games', params=params)
+        self.response.set_status(204)
+
+    @staticmethod
+    def _compact_finished(expiring, cursor):
+        """Drop the deck and freeze the history of finished games that have
+        not been compacted yet, skipping those last written before expiring.
+        Only equality filters are used so no composite index is needed.
+        Returns the count compacted, the cursor and whether more remain."""
+        query = Game.query(Game.game_over == True,
+                           Game.compacted == False)
+        count = 0
+        more = True
+        pages = 0
+        while more and pages < TASK_PAGES:
+            games, cursor, more = query.fetch_page(CLEANUP_BATCH_SIZE,
+                                                   start_cursor=cursor)
+            compacted = [game for game in games
+                         if not (game.last_active and
+                                 game.last_active < expiring) and
+                         game.compact()]
+            ndb.put_multi(compacted)
+            count += len(compacted)
+            pages += 1
+        return count, cursor, more
+
+    @staticmethod
+    def _expire_inactive(cutoff, cursor):
+        """Delete games last written before cutoff with batched deletes and
+        drop the unfinished ones from their users' ActiveGames. Their cached
+        etags are deleted too, as the tags of finished games never expire.
+        Returns the count deleted, the cursor and whether more remain."""
+        from google.appengine.api import memcache
+        from api import MEMCACHE_GAME_ETAG
+        query = Game.query(Game.last_active < cutoff)
+        count = 0
+        more = True
+        pages = 0
+        while more and pages < TASK_PAGES:
+            games, cursor, more = query.fetch_page(CLEANUP_BATCH_SIZE,
+                                                   start_cursor=cursor)
+            keys = [game.key for game in games]
+            # Stored move responses are children of the game and go with it.
+            children = [MoveRecord.query(ancestor=key).fetch_async(
+                keys_only=True) for key in keys]
+            ndb.delete_multi(keys + [child for future in children
+                                     for child in future.get_result()])
+            memcache.delete_multi([MEMCACHE_GAME_ETAG.format(key.urlsafe())
+                                   for key in keys])
+            unfinished = defaultdict(list)
+            for game in games:
+                if not game.game_over:
+                    unfinished[game.user].append(game.key)
+            for user_key, game_keys in unfinished.iteritems():
+                ndb.transaction(lambda: ActiveGames.remove(user_key,
+                                                           *game_keys))
+            count += len(keys)
+            pages += 1
+        return count, cursor, more
+
+
+class BackfillGames(webapp2.RequestHandler):
+    def post(self):
+        """Write compacted and last_active to games stored before those
+        properties existed, so the cleanup queries can find them. Legacy
+        games get their ended time, or now, as their last activity. Runs
+        once at rollout as a chain of tasks, each resuming from the cursor
+        of the last."""
+        from google.appengine.api import taskqueue
+        from google.appengine.datastore.datastore_query import Cursor
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+        query = Game.query()
+        now = datetime.now()
+        more = True
+        pages = 0
+        while more and pages < TASK_PAGES:
+            games, cursor, more = query.fetch_page(CLEANUP_BATCH_SIZE,
+                                                   start_cursor=cursor)
+            legacy = [game for game in games if game.last_active is None]
+            for game in legacy:
+                game.last_active = game.ended or now
+            # The put also writes compacted, defaulting to False.
+            ndb.put_multi(legacy)
+            pages += 1
+        if more and cursor:
+            taskqueue.add(url='/tasks/backfill_games',
+                          params={'cursor': cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class RebuildActiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Start a chain of tasks that repairs drift between each User's
+        ActiveGames index and their unfinished games, and creates the index
+        of users that have none. Called once a day using a cron job and
+        once at rollout"""
+        from google.appengine.api import taskqueue
+        taskqueue.add(url='/tasks/rebuild_active_games')
+        self.response.set_status(204)
+
+    def post(self):
+        """Rebuild the indexes of at most REBUILD_PAGES pages of users and
+        continue in a new task from the cursor of the last."""
+        from google.appengine.api import taskqueue
+        from google.appengine.datastore.datastore_query import Cursor
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+        more = True
+        pages = 0
+        repaired = 0
+        while more and pages < REBUILD_PAGES:
+            keys, cursor, more = User.query().fetch_page(
+                CLEANUP_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+            for user_key in keys:
+                if self._rebuild(user_key):
+                    repaired += 1
+            pages += 1
+        logging.info('Repaired the active games of %d users.', repaired)
+        if more and cursor:
+            taskqueue.add(url='/tasks/rebuild_active_games',
+                          params={'cursor': cursor.urlsafe()})
+        self.response.set_status(204)
+
+    @staticmethod
+    def _rebuild(user_key):
+        """Rebuilds one user's index. The (game_over, user) query is only
+        eventually consistent, so every candidate is checked with a key get
+        first, and games added while this runs are kept. Games to add are
+        read again inside the transaction, so one that ends or is cancelled
+        meanwhile is not put back."""
+        index = ActiveGames.key_for(user_key).get()
+        indexed = index.games if index else []
+        found = Game.query(Game.user == user_key)\
+                    .filter(Game.game_over == False).fetch(keys_only=True)
+        candidates = list(set(indexed) | set(found))
+        live = set(game.key for game in ndb.get_multi(candidates)
+                   if game and not game.game_over)
+        if index and set(indexed) == live:
+            return False
+
+        def update(added):
+            index = ActiveGames.key_for(user_key).get() or \
+                ActiveGames(key=ActiveGames.key_for(user_key))
+            games = [key for key in index.games
+                     if key in live or key not in candidates]
+            games.extend(game.key for game in ndb.get_multi(
+                [key for key in added if key not in games])
+                if game and not game.game_over)
+            index.games = games
+            index.put()
+
+        added = [key for key in live if key not in indexed]
+        # A transaction spans at most 25 entity groups: the index's and up to
+        # REBUILD_TXN_GAMES games.
+        for start in range(0, max(len(added), 1), REBUILD_TXN_GAMES):
+            ndb.transaction(
+                lambda: update(added[start:start + REBUILD_TXN_GAMES]),
+                xg=True)
+        return True
+
+
+class ExportEntities(webapp2.RequestHandler):
+    def get(self, kind):
+        """Export all Scores or Games as gzip compressed NDJSON.
+        Pages through the query with cursors and compresses each page as it
+        is read, so only one page of entities is held at a time. At most
+        EXPORT_MAX_PAGES pages are written per request; the cursor to resume
+        from is returned in the X-Export-Cursor header and is empty once the
+        export is complete."""
+        from google.appengine.datastore.datastore_query import Cursor
+        cursor = None
+        if self.request.get('cursor'):
+            try:
+                cursor = Cursor(urlsafe=self.request.get('cursor'))
+            except Exception:
+                self.abort(400, 'Invalid cursor')
+        query = EXPORT_QUERIES[kind]()
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        more = True
+        pages = 0
+        while more and pages < EXPORT_MAX_PAGES:
+            entities, cursor, more = query.fetch_page(
+                EXPORT_PAGE_SIZE, start_cursor=cursor,
+                batch_size=EXPORT_PAGE_SIZE)
+            user_keys = list(set(entity.user for entity in entities))
+            names = dict((user.key, user.name) for user
+                         in ndb.get_multi(user_keys) if user)
+            lines = [json.dumps(entity.to_record(names.get(entity.user)))
+                     for entity in entities]
+            if lines:
+                self.response.write(compressor.compress(
+                    '\n'.join(lines) + '\n'))
+            pages += 1
+        self.response.write(compressor.flush())
+        self.response.headers['Content-Type'] = 'application/gzip'
+        self.response.headers['Content-Disposition'] = \
+            'attachment; filename={}.ndjson.gz'.format(kind)
+        self.response.headers['X-Export-Cursor'] = \
+            cursor.urlsafe() if more and cursor else ''
+
+
+class ThrottleStats(webapp2.RequestHandler):
+    def get(self):
+        """Return the allowed and dropped request counts of every rate
+        limiter as JSON, for monitoring."""
+        import throttle
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(throttle.get_stats()))
+
+
+class DownloadProfile(webapp2.RequestHandler):
+    def get(self, profile_id=None):
+        """Without an id, list the most recent request profiles as JSON.
+        With an id, return that profile as collapsed stacks (the input format
+        of flamegraph.pl), or as its RPC timeline with format=timeline."""
+        from models import RequestProfile
+        if not profile_id:
+            profiles = RequestProfile.query().order(
+                -RequestProfile.created).fetch(50)
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps([
+                {'id': profile.key.id(), 'method': profile.method,
+                 'created': profile.created.isoformat(),
+                 'duration_ms': profile.duration_ms}
+                for profile in profiles]))
+            return
+        profile = RequestProfile.get_by_id(int(profile_id))
+        if not profile:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'text/plain'
+        if self.request.get('format') == 'timeline':
+            for name, start, end, failed in json.loads(profile.rpcs):
+                self.response.write('{:>9.1f} {:>9.1f}  {}{}\n'.format(
+                    start, end - start, name, ' FAILED' if failed else ''))
+        else:
+            self.response.headers['Content-Disposition'] = \
+                'attachment; filename=profile-{}.folded'.format(profile_id)
+            self.response.write(profile.stacks)
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Preload the modules and lookup tables that regular requests need.
+        Called by App Engine when it starts a new instance, before the
+        instance receives traffic. The time taken is logged so cold start
+        cost can be tracked."""
+        start = time.time()
+        import api  # noqa: endpoints, protorpc and every API message class
+        from google.appengine.api import memcache, taskqueue  # noqa
+        # Touch the precomputed tables so any lazy work happens now.
+        utils.calc_val(utils.create_deck())
+        logging.info('Warmup completed in %.1f ms',
+                     (time.time() - start) * 1000)
+        self.response.set_status(200)
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
     ('/tasks/cache_average_winrate', UpdateAverageWinrate),
+    ('/crons/cleanup_games', CleanupGames),
+    ('/tasks/cleanup_games', CleanupGames),
+    ('/tasks/backfill_games', BackfillGames),
+    ('/crons/rebuild_active_games', RebuildActiveGames),
+    ('/tasks/rebuild_active_games', RebuildActiveGames),
+    ('/export/(scores|games)', ExportEntities),
+    ('/admin/throttle_stats', ThrottleStats),
+    ('/admin/profiles', DownloadProfile),
+    ('/admin/profiles/(\d+)', DownloadProfile),
+    ('/_ah/warmup', Warmup),
 ], debug=True)
@@ -3,8 +3,8 @@ entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
 from utils import create_deck, calc_val
-from datetime import date
-from protorpc import messages
+from datetime import date, datetime
+from protorpc import messages, protojson
 from google.appengine.ext import ndb
 
 
@@ -16,6 +16,37 @@ class User(ndb.Model):
     total_games = ndb.IntegerProperty(default=0)
 
 
+class ActiveGames(ndb.Model):
+    """The keys of a User's unfinished games. A child of the User, so it is
+    read with a strongly consistent key get and updated in the same
+    transaction as the games it lists, instead of querying the
+    (game_over, user) index."""
+    games = ndb.KeyProperty(repeated=True, kind='Game', indexed=False)
+
+    @staticmethod
+    def key_for(user_key):
+        """Returns the key of a User's ActiveGames"""
+        return ndb.Key(ActiveGames, 'active', parent=user_key)
+
+    @classmethod
+    def add(cls, user_key, game_key):
+        """Adds game_key to the user's active games. Call inside the
+           transaction that creates the game."""
+        index = cls.key_for(user_key).get() or cls(key=cls.key_for(user_key))
+        index.games.append(game_key)
+        index.put()
+
+    @classmethod
+    def remove(cls, user_key, *game_keys):
+        """Removes game_keys from the user's active games. Call inside the
+           transaction that ends or deletes the games."""
+        index = cls.key_for(user_key).get()
+        if index and any(key in index.games for key in game_keys):
+            index.games = [key for key in index.games
+                           if key not in game_keys]
+            index.put()
+
+
 class Game(ndb.Model):
     """Game object"""
     deck = ndb.StringProperty(repeated=True, indexed=False)
@@ -27,6 +58,13 @@ class Game(ndb.Model):
     game_over = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
     history = ndb.StringProperty(repeated=True, indexed=False)
+    history_archive = ndb.TextProperty(compressed=True)
+    compacted = ndb.BooleanProperty(default=False)
+    # Set explicitly by new_game and touch() rather than auto_now, so that
+    # compaction does not restart the game's TTL.
+    last_active = ndb.DateTimeProperty()
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    ended = ndb.DateTimeProperty()
 
     EVENTS = {
         'START': "Game Started with player cards {} and {}. The dealer's shown"
@@ -49,7 +87,8 @@ class Game(ndb.Model):
     def new_game(cls, user):
         """Creates and returns a new game"""
         game = Game(user=user,
-                    game_over=False)
+                    game_over=False,
+                    last_active=datetime.now())
         game.deck = create_deck()
         start_string = 'START'
 
@@ -70,26 +109,66 @@ class Game(ndb.Model):
 
         game.history.append(start_string)
 
-        game.put()
+        def put_game():
+            game.put()
+            ActiveGames.add(user, game.key)
+        ndb.transaction(put_game, xg=True)
         return game
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def to_form(self, message, fields=None, user_name=None):
+        """Returns a GameForm representation of the Game. If fields is given
+           only those fields (and always urlsafe_key) are populated.
+           user_name saves the User lookup when the caller already knows
+           it."""
+        def wanted(name):
+            return fields is None or name in fields
+
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
-        form.player_cards = self.player_cards
-        form.dealer_cards = self.dealer_cards
-        form.player_val = self.player_val
-        form.dealer_val = self.dealer_val
-        form.game_over = self.game_over
-        form.message = message
+        if wanted('user_name'):
+            form.user_name = user_name or self.user.get().name
+        if wanted('player_cards'):
+            form.player_cards = self.player_cards
+        if wanted('dealer_cards'):
+            form.dealer_cards = self.dealer_cards
+        if wanted('player_val'):
+            form.player_val = self.player_val
+        if wanted('dealer_val'):
+            form.dealer_val = self.dealer_val
+        if wanted('game_over'):
+            form.game_over = self.game_over
+        if wanted('version'):
+            form.version = self.version
+        if wanted('etag'):
+            form.etag = self.etag()
+        if wanted('message'):
+            form.message = message
         return form
 
+    def etag(self):
+        """Returns the entity tag of the game's current state. Finished games
+           never change again, so their tag is marked final."""
+        if self.game_over:
+            return '"v{}-final"'.format(self.version)
+        return '"v{}"'.format(self.version)
+
+    def to_record(self, user_name):
+        """Returns a plain dict representation of the Game for export"""
+        return {'key': self.key.urlsafe(),
+                'user_name': user_name,
+                'game_over': self.game_over,
+                'player_cards': self.player_cards,
+                'dealer_cards': self.dealer_cards,
+                'player_val': self.player_val,
+                'dealer_val': self.dealer_val,
+                'history': self.events(),
+                'last_active': self.last_active and
+                self.last_active.isoformat()}
+
     def get_history(self):
         """Returns a formatted game history."""
         history = EventForms()
-        for event in self.history:
+        for event in self.events():
             form = EventForm()
             # certain events have relevant cards attached to them,
             # the following procedure separates them.
@@ -110,8 +189,50 @@ class Game(ndb.Model):
             else:
                 form.description = Game.EVENTS[event_name]
             history.events.append(form)
+        history.etag = self.etag()
         return history
 
+    def touch(self):
+        """Records that a move changed the game by bumping its version and
+           last_active time. Does not put the entity."""
+        self.version += 1
+        self.last_active = datetime.now()
+
+    def events(self):
+        """Returns the raw history tokens, whether live or archived."""
+        if self.compacted:
+            return self.history_archive.split('|') if self.history_archive \
+                else []
+        return self.history
+
+    def compact(self):
+        """Drops the state a finished game no longer needs. The remaining
+           deck is discarded and the history is frozen into a single
+           compressed text blob. Does not put the entity."""
+        if not self.game_over or self.compacted:
+            return False
+        self.deck = []
+        self.dealer_hidden = ''
+        self.history_archive = '|'.join(self.history)
+        self.history = []
+        self.compacted = True
+        return True
+
+    def cancel(self):
+        """Deletes the game, its stored move responses and its entry in
+           the user's active games in one transaction. Returns False,
+           deleting nothing, if the game has ended or been deleted since it
+           was read."""
+        def delete_game():
+            game = self.key.get()
+            if not game or game.game_over:
+                return False
+            keys = MoveRecord.query(ancestor=self.key).fetch(keys_only=True)
+            ndb.delete_multi([self.key] + keys)
+            ActiveGames.remove(self.user, self.key)
+            return True
+        return ndb.transaction(delete_game, xg=True)
+
     def append_history(self, event):
         """Appends an event to the game history."""
         self.history.append(event)
@@ -123,10 +244,13 @@ class Game(ndb.Model):
            If tied is True, then the player tied."""
         self.history.append('GAME_OVER')
         self.game_over = True
+        self.ended = datetime.now()
         self.put()
+        ActiveGames.remove(self.user, self.key)
 
-        # Recalculate the user's points
-        user = User.query(User.key == self.user).get()
+        # Recalculate the user's points. A key get rather than a query so this
+        # can run inside make_move's transaction.
+        user = self.user.get()
         if tied:
             user.points += 1
         elif won:
@@ -135,7 +259,8 @@ class Game(ndb.Model):
         user.put()
 
         # Add the game to the score 'board'
-        score = Score(user=self.user, date=date.today(), won=won, tied=tied)
+        score = Score(key=Score.key_for(self.key), user=self.user,
+                      game=self.key, date=date.today(), won=won, tied=tied)
         score.put()
 
     def reveal(self):
@@ -224,28 +349,329 @@ class Game(ndb.Model):
         return result
 
 
+class Table(ndb.Model):
+    """Table object. One round of blackjack in which several seats play
+    against the dealer and draw from one shared shoe. Each Seat is its own
+    root entity so players never contend for the same entity group, and the
+    shoe's draw position lives in a separate ShoePosition entity. The Table
+    itself is only written when it is created and when the dealer's turn
+    resolves every seat at once."""
+    shoe = ndb.StringProperty(repeated=True, indexed=False)
+    seats = ndb.KeyProperty(repeated=True, kind='Seat', indexed=False)
+    dealer_cards = ndb.StringProperty(repeated=True, indexed=False)
+    dealer_hidden = ndb.StringProperty(indexed=False)
+    dealer_val = ndb.IntegerProperty(indexed=False)
+    round_over = ndb.BooleanProperty(required=True, default=False)
+    history = ndb.StringProperty(repeated=True, indexed=False)
+    last_active = ndb.DateTimeProperty(auto_now=True)
+
+    DECKS = 6
+    MAX_SEATS = 5
+    # Shoe positions a seat or the dealer takes at a time. Drawing within a
+    # block needs no write to the shared ShoePosition.
+    BLOCK_SIZE = 6
+
+    @classmethod
+    def new_table(cls, users):
+        """Creates and returns a new table with a seat for each user key.
+           The dealer and every seat are dealt in and all the entities are
+           written in one batch."""
+        table_key = ndb.Key(Table, Table.allocate_ids(1)[0])
+        first, last = Seat.allocate_ids(len(users))
+        seat_keys = [ndb.Key(Seat, seat_id)
+                     for seat_id in range(first, last + 1)]
+        table = Table(key=table_key, seats=seat_keys)
+        table.shoe = create_deck(Table.DECKS)
+        table.dealer_cards = [table.shoe[0]]
+        table.dealer_hidden = table.shoe[1]
+        table.dealer_val = calc_val(table.dealer_cards)
+        table.history = ['START.{}.{}'.format(*table.shoe[0:2])]
+
+        position = 2
+        seats = []
+        for seat_key, user in zip(seat_keys, users):
+            seat = Seat(key=seat_key, table=table_key, user=user,
+                        next_card=position,
+                        block_end=position + Table.BLOCK_SIZE)
+            position += Table.BLOCK_SIZE
+            seat.player_cards = [seat.draw(table.shoe), seat.draw(table.shoe)]
+            seat.player_val = calc_val(seat.player_cards)
+            seat.history = ['START.{}.{}'.format(*seat.player_cards)]
+            # A natural blackjack has nothing left to play.
+            seat.done = seat.player_val == 21
+            seats.append(seat)
+        ndb.put_multi([table, ShoePosition(id=table_key.id(),
+                                           position=position)] + seats)
+        return table, seats
+
+    @classmethod
+    def resolve(cls, table_key):
+        """Plays the dealer's turn once every seat is done and settles all
+           the seats, their users and their Scores in one transactional
+           write. Returns True if this call resolved the round."""
+        table = table_key.get()
+        if table.round_over:
+            return False
+        if not all(seat.done for seat in ndb.get_multi(table.seats)):
+            return False
+        return ndb.transaction(lambda: cls._resolve_txn(table_key),
+                               xg=True)
+
+    @staticmethod
+    def _resolve_txn(table_key):
+        table = table_key.get()
+        if table.round_over:
+            return False
+        seats = ndb.get_multi(table.seats)
+
+        table.dealer_cards.append(table.dealer_hidden)
+        table.history.append('REVEAL.' + table.dealer_hidden)
+        table.dealer_hidden = ''
+        table.dealer_val = calc_val(table.dealer_cards)
+        dealer_blackjack = table.dealer_val == 21
+        if not all(seat.result == 'P_BUST' for seat in seats):
+            next_card = block_end = 0
+            # The dealer hits below 17 and stands on every 17.
+            while table.dealer_val < 17:
+                if next_card == block_end:
+                    next_card = ShoePosition.allocate(table_key,
+                                                      Table.BLOCK_SIZE)
+                    block_end = next_card + Table.BLOCK_SIZE
+                card = table.shoe[next_card]
+                next_card += 1
+                table.dealer_cards.append(card)
+                table.dealer_val = calc_val(table.dealer_cards)
+                table.history.append('D_HIT.' + card)
+
+        users = dict((user.key, user) for user in
+                     ndb.get_multi(list(set(seat.user for seat in seats))))
+        scores = []
+        for seat in seats:
+            seat.result = seat.outcome(table.dealer_val, dealer_blackjack)
+            seat.history.extend([seat.result, 'GAME_OVER'])
+            won, tied = Seat.RESULTS[seat.result]
+            user = users[seat.user]
+            user.points += 1 if tied else 2 if won else 0
+            user.total_games += 1
+            scores.append(Score(user=seat.user, date=date.today(), won=won,
+                                tied=tied))
+        table.round_over = True
+        ndb.put_multi([table] + seats + users.values() + scores)
+        return True
+
+    def to_form(self, seats, user_names):
+        """Returns a TableForm representation of the Table and its seats.
+           user_names maps user keys to names."""
+        return TableForm(urlsafe_key=self.key.urlsafe(),
+                         dealer_cards=self.dealer_cards,
+                         dealer_val=self.dealer_val,
+                         round_over=self.round_over,
+                         seats=[seat.to_form('', user_names[seat.user])
+                                for seat in seats])
+
+
+class ShoePosition(ndb.Model):
+    """The next undealt position of a Table's shoe. Keyed by the table id
+    but kept in its own entity group, so allocating cards never contends
+    with writes to the Table."""
+    position = ndb.IntegerProperty(required=True, indexed=False)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def allocate(table_key, count):
+        """Reserves count consecutive positions of the shoe and returns the
+           first. Joins the caller's transaction if there is one."""
+        shoe_position = ShoePosition.get_by_id(table_key.id())
+        start = shoe_position.position
+        shoe_position.position += count
+        shoe_position.put()
+        return start
+
+
+class Seat(ndb.Model):
+    """Seat object. One player's hand at a Table."""
+    table = ndb.KeyProperty(required=True, kind='Table')
+    user = ndb.KeyProperty(required=True, kind='User')
+    player_cards = ndb.StringProperty(repeated=True, indexed=False)
+    player_val = ndb.IntegerProperty(indexed=False)
+    next_card = ndb.IntegerProperty(required=True, indexed=False)
+    block_end = ndb.IntegerProperty(required=True, indexed=False)
+    done = ndb.BooleanProperty(required=True, default=False, indexed=False)
+    result = ndb.StringProperty(indexed=False)
+    history = ndb.StringProperty(repeated=True, indexed=False)
+
+    # (won, tied) for each result, as passed to Game.end_game.
+    RESULTS = {
+        'P_BUST': (False, False),
+        'D_BUST': (True, False),
+        'P_BLK_JK': (True, False),
+        'D_BLK_JK': (False, False),
+        'P_WIN': (True, False),
+        'D_WIN': (False, False),
+        'TIE': (True, True),
+    }
+
+    def draw(self, shoe):
+        """Draws the next card of the seat's block of the shoe, reserving a
+           new block first if this one is used up."""
+        if self.next_card == self.block_end:
+            self.next_card = ShoePosition.allocate(self.table,
+                                                   Table.BLOCK_SIZE)
+            self.block_end = self.next_card + Table.BLOCK_SIZE
+        card = shoe[self.next_card]
+        self.next_card += 1
+        return card
+
+    def hit(self, shoe):
+        """Draw a card and recalculate value. A bust finishes the seat.
+           If value is over 21 returns False, otherwise returns True."""
+        card = self.draw(shoe)
+        self.player_cards.append(card)
+        self.player_val = calc_val(self.player_cards)
+        self.history.append('P_HIT.' + card)
+        if self.player_val > 21:
+            self.done = True
+            self.result = 'P_BUST'
+            return False
+        return True
+
+    def stand(self):
+        self.history.append('STAND')
+        self.done = True
+
+    def outcome(self, dealer_val, dealer_blackjack):
+        """Returns the seat's result against the dealer's final hand"""
+        blackjack = self.player_val == 21 and len(self.player_cards) == 2
+        if self.result == 'P_BUST':
+            return 'P_BUST'
+        elif blackjack:
+            return 'TIE' if dealer_blackjack else 'P_BLK_JK'
+        elif dealer_blackjack:
+            return 'D_BLK_JK'
+        elif dealer_val > 21:
+            return 'D_BUST'
+        elif self.player_val > dealer_val:
+            return 'P_WIN'
+        elif self.player_val < dealer_val:
+            return 'D_WIN'
+        return 'TIE'
+
+    def to_form(self, message, user_name=None):
+        """Returns a SeatForm representation of the Seat"""
+        return SeatForm(urlsafe_key=self.key.urlsafe(),
+                        user_name=user_name or self.user.get().name,
+                        player_cards=self.player_cards,
+                        player_val=self.player_val,
+                        done=self.done,
+                        result=self.result,
+                        message=message)
+
+
+class MoveRecord(ndb.Model):
+    """The stored response to a make_move request carrying an idempotency
+    key. Child of the Game, with the idempotency key as its id, so it is
+    written in the same transaction as the move it records."""
+    response = ndb.TextProperty(required=True)
+
+    @classmethod
+    def record(cls, game_key, idempotency_key, form):
+        """Stores form as the response for idempotency_key"""
+        record = cls(parent=game_key, id=idempotency_key,
+                     response=protojson.encode_message(form))
+        record.put()
+        return record
+
+    def to_form(self):
+        """Returns the stored GameForm"""
+        return protojson.decode_message(GameForm, self.response)
+
+
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     tied = ndb.BooleanProperty(required=True)
+    game = ndb.KeyProperty(kind='Game')
+
+    @staticmethod
+    def key_for(game_key):
+        """Returns the key of the Score recorded for a game. Scores are keyed
+           by their game so they can be fetched without a query."""
+        return ndb.Key(Score, str(game_key.id()))
+
+    def to_form(self, fields=None, user_name=None):
+        """Returns a ScoreForm representation of the Score. If fields is
+           given only those fields are populated, so a projection of just
+           those properties is enough. user_name saves the User lookup when
+           the caller already knows it."""
+        form = ScoreForm()
+        if fields is None or 'user_name' in fields:
+            form.user_name = user_name or self.user.get().name
+        if fields is None or 'date' in fields:
+            form.date = str(self.date)
+        if fields is None or 'won' in fields:
+            form.won = self.won
+        if fields is None or 'tied' in fields:
+            form.tied = self.tied
+        return form
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
-                         date=str(self.date), tied=self.tied)
+    def to_record(self, user_name):
+        """Returns a plain dict representation of the Score for export"""
+        return {'key': self.key.urlsafe(), 'user_name': user_name,
+                'date': str(self.date), 'won': self.won, 'tied': self.tied}
+
+
+class RequestProfile(ndb.Model):
+    """A profile of one API request, captured by profiler.py"""
+    method = ndb.StringProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    duration_ms = ndb.FloatProperty(indexed=False)
+    # One "frame;frame;frame count" line per distinct stack.
+    stacks = ndb.TextProperty(compressed=True)
+    # JSON list of [service.call, start ms, end ms, failed] per RPC.
+    rpcs = ndb.TextProperty(compressed=True)
 
 
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
+    """GameForm for outbound game state information. Only urlsafe_key is
+    required so that a fields mask can leave the rest out."""
     urlsafe_key = messages.StringField(1, required=True)
     player_cards = messages.StringField(2, repeated=True)
-    game_over = messages.BooleanField(3, required=True)
-    message = messages.StringField(4, required=True)
-    user_name = messages.StringField(5, required=True)
+    game_over = messages.BooleanField(3)
+    message = messages.StringField(4)
+    user_name = messages.StringField(5)
     dealer_cards = messages.StringField(6, repeated=True)
-    player_val = messages.IntegerField(7, required=True)
-    dealer_val = messages.IntegerField(8, required=True)
+    player_val = messages.IntegerField(7)
+    dealer_val = messages.IntegerField(8)
+    version = messages.IntegerField(9)
+    etag = messages.StringField(10)
+    not_modified = messages.BooleanField(11)
+
+
+class SeatForm(messages.Message):
+    """SeatForm for outbound seat state information"""
+    urlsafe_key = messages.StringField(1, required=True)
+    user_name = messages.StringField(2)
+    player_cards = messages.StringField(3, repeated=True)
+    player_val = messages.IntegerField(4)
+    done = messages.BooleanField(5)
+    result = messages.StringField(6)
+    message = messages.StringField(7)
+
+
+class TableForm(messages.Message):
+    """TableForm for outbound table state information"""
+    urlsafe_key = messages.StringField(1, required=True)
+    dealer_cards = messages.StringField(2, repeated=True)
+    dealer_val = messages.IntegerField(3)
+    round_over = messages.BooleanField(4)
+    seats = messages.MessageField(SeatForm, 5, repeated=True)
+
+
+class NewTableForm(messages.Message):
+    """Used to create a new table"""
+    user_names = messages.StringField(1, repeated=True)
 
 
 class NewGameForm(messages.Message):
@@ -256,14 +682,17 @@ class NewGameForm(messages.Message):
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     move = messages.StringField(1, required=True)
+    version = messages.IntegerField(2)
+    idempotency_key = messages.StringField(3)
 
 
 class ScoreForm(messages.Message):
-    """ScoreForm for outbound Score information"""
-    user_name = messages.StringField(1, required=True)
-    date = messages.StringField(2, required=True)
-    won = messages.BooleanField(3, required=True)
-    tied = messages.BooleanField(4, required=True)
+    """ScoreForm for outbound Score information. No field is required so
+    that a fields mask can leave any of them out."""
+    user_name = messages.StringField(1)
+    date = messages.StringField(2)
+    won = messages.BooleanField(3)
+    tied = messages.BooleanField(4)
 
 
 class ScoreForms(messages.Message):
@@ -295,4 +724,6 @@ class EventForm(messages.Message):
 class EventForms(messages.Message):
     """Return Game history events"""
     events = messages.MessageField(EventForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    not_modified = messages.BooleanField(3)
 
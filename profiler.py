@@ -0,0 +1,142 @@
+"""profiler.py - On demand sampling profiler for API requests.
+
+An endpoint method wrapped with @profiled is profiled when the request has
+an X-Blackjack-Profile header equal to the PROFILE_TOKEN environment
+variable, or when it is picked at random at PROFILE_SAMPLE_RATE. While it
+runs, a background thread samples the request thread's stack and every API
+RPC it makes (datastore, memcache, taskqueue) is timed. The result is stored
+as a RequestProfile and can be downloaded from /admin/profiles as collapsed
+stacks for flamegraph.pl or as an RPC timeline.
+
+When a request is not profiled the only cost is the header check, plus a
+dictionary lookup per RPC in the hooks below."""
+
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import thread
+import threading
+import time
+from collections import defaultdict
+
+from google.appengine.api import apiproxy_stub_map
+
+from models import RequestProfile
+
+PROFILE_HEADER = 'X-Blackjack-Profile'
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+SAMPLE_INTERVAL = 0.005
+MAX_STACK_DEPTH = 100
+
+# Thread id -> the _Profile running on that thread.
+_active = {}
+
+
+class _Profile(object):
+    """Samples one thread's stack and records its RPCs until stopped"""
+    def __init__(self, name):
+        self.name = name
+        self.thread_id = thread.get_ident()
+        self.stacks = defaultdict(int)
+        self.rpcs = []
+        self.pending = {}
+        self.stopping = threading.Event()
+        self.sampler = threading.Thread(target=self._sample)
+        self.sampler.daemon = True
+
+    def start(self):
+        self.started = time.time()
+        _active[self.thread_id] = self
+        self.sampler.start()
+
+    def stop(self):
+        self.duration = time.time() - self.started
+        del _active[self.thread_id]
+        self.stopping.set()
+        self.sampler.join()
+
+    def _sample(self):
+        while not self.stopping.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append('{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def rpc_started(self, service, call, response):
+        self.pending[id(response)] = ('{}.{}'.format(service, call),
+                                      time.time())
+
+    def rpc_finished(self, response, error):
+        name, start = self.pending.pop(id(response), (None, None))
+        if name:
+            self.rpcs.append((name, (start - self.started) * 1000,
+                              (time.time() - self.started) * 1000,
+                              error is not None))
+
+    def save(self):
+        """Starts storing the profile and returns the put's future"""
+        profile = RequestProfile(
+            method=self.name, duration_ms=self.duration * 1000,
+            stacks='\n'.join('{} {}'.format(stack, count) for stack, count
+                             in sorted(self.stacks.iteritems())),
+            rpcs=json.dumps(self.rpcs))
+        return profile.put_async()
+
+
+def _pre_call(service, call, request, response, rpc=None):
+    profile = _active.get(thread.get_ident())
+    if profile:
+        profile.rpc_started(service, call, response)
+
+
+def _post_call(service, call, request, response, rpc=None, error=None):
+    profile = _active.get(thread.get_ident())
+    if profile:
+        profile.rpc_finished(response, error)
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    'request_profiler', _pre_call)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'request_profiler', _post_call)
+
+
+def _should_profile(service):
+    headers = getattr(getattr(service, 'request_state', None), 'headers',
+                      None)
+    if PROFILE_TOKEN and headers and \
+            headers.get(PROFILE_HEADER) == PROFILE_TOKEN:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def profiled(method):
+    """Decorator for endpoint methods that profiles selected requests"""
+    @functools.wraps(method)
+    def wrapper(service, request):
+        if not _should_profile(service):
+            return method(service, request)
+        profile = _Profile(method.__name__)
+        profile.start()
+        try:
+            return method(service, request)
+        finally:
+            profile.stop()
+            # Nothing waits on RPCs left pending when the request ends, so
+            # the put is waited on here or the profile may never be stored.
+            # A failed save must not replace the endpoint's own result.
+            try:
+                profile.save().get_result()
+            except Exception:
+                logging.exception('Could not store the profile of %s.',
+                                  method.__name__)
+    return wrapper
@@ -0,0 +1,134 @@
+"""throttle.py - Per user and per game request throttling for the API.
+
+Each throttled endpoint gets a budget of requests per time window for every
+subject (a user name or a game key). The budget is shared by all instances
+through a memcache counter, but instances lease it in blocks of tokens so
+most requests are decided from an in-instance bucket without a memcache
+call. Allowed and dropped counts are flushed to memcache for monitoring."""
+
+import threading
+import time
+
+from google.appengine.api import memcache
+
+# Endpoint name: (requests allowed per subject per window, window seconds)
+RATE_LIMITS = {
+    'new_game': (10, 60),
+    'make_move': (60, 60),
+}
+# Tokens an instance takes from the shared budget at a time.
+LEASE_SIZE = 5
+# Buckets of past windows are dropped once an instance holds this many.
+MAX_BUCKETS = 10000
+STATS_FLUSH_INTERVAL = 10
+
+MEMCACHE_BUDGET = 'THROTTLE:{}:{}:{}'
+MEMCACHE_STATS = 'THROTTLE_STATS:{}:{}'
+
+
+class RateLimiter(object):
+    """Token bucket limiter for one endpoint"""
+    def __init__(self, name, limit, window, lease=LEASE_SIZE):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.lease = min(lease, limit)
+        self.lock = threading.Lock()
+        # subject -> [window number, tokens left, budget exhausted]
+        self.buckets = {}
+        self.counts = {'allowed': 0, 'dropped': 0}
+        self.flushed = time.time()
+
+    def allow(self, subject):
+        """Takes a token for subject. Returns False if its budget for the
+           current window is spent."""
+        now = time.time()
+        window = int(now // self.window)
+        with self.lock:
+            bucket = self._bucket(subject, window)
+            allowed = self._take(bucket)
+            lease = allowed is None
+        if lease:
+            # The memcache call is made without the lock so other requests
+            # on this instance are not held up behind it.
+            granted, exhausted = self._lease(subject, window)
+            with self.lock:
+                bucket = self._bucket(subject, window)
+                bucket[1] += granted
+                bucket[2] = bucket[2] or exhausted
+                allowed = bool(self._take(bucket))
+        with self.lock:
+            self.counts['allowed' if allowed else 'dropped'] += 1
+            if now - self.flushed > STATS_FLUSH_INTERVAL:
+                self._flush_stats(now)
+        return allowed
+
+    def _bucket(self, subject, window):
+        """Returns subject's bucket for window. Called with the lock held."""
+        bucket = self.buckets.get(subject)
+        if bucket is None or bucket[0] != window:
+            bucket = self.buckets[subject] = [window, 0, False]
+            if len(self.buckets) > MAX_BUCKETS:
+                self._prune(window)
+        return bucket
+
+    @staticmethod
+    def _take(bucket):
+        """Takes a token from bucket. Returns None if it is empty and more
+           can still be leased. Called with the lock held."""
+        if bucket[1] > 0:
+            bucket[1] -= 1
+            return True
+        return False if bucket[2] else None
+
+    def _lease(self, subject, window):
+        """Takes up to lease tokens from the shared budget. Returns the
+           tokens granted and whether the budget is now exhausted."""
+        key = MEMCACHE_BUDGET.format(self.name, subject, window)
+        # incr with an initial_value would create the key without an expiry.
+        memcache.add(key, 0, time=self.window)
+        total = memcache.incr(key, delta=self.lease)
+        if total is None:
+            # Memcache is unavailable; fail open on the local lease.
+            return self.lease, False
+        granted = max(0, min(self.lease, self.limit - (total - self.lease)))
+        return granted, total >= self.limit
+
+    def _prune(self, window):
+        for subject in [subject for subject, bucket
+                        in self.buckets.iteritems() if bucket[0] != window]:
+            del self.buckets[subject]
+
+    def _flush_stats(self, now):
+        """Adds the counts since the last flush to the shared counters. The
+           RPC is not waited on."""
+        offsets = dict((MEMCACHE_STATS.format(self.name, kind), count)
+                       for kind, count in self.counts.iteritems() if count)
+        if offsets:
+            memcache.Client().offset_multi_async(offsets, initial_value=0)
+        self.counts = {'allowed': 0, 'dropped': 0}
+        self.flushed = now
+
+
+LIMITERS = dict((name, RateLimiter(name, limit, window))
+                for name, (limit, window) in RATE_LIMITS.iteritems())
+
+
+def allow(endpoint, subject):
+    """Returns False if subject has used up its budget for endpoint.
+       Endpoints without a configured limit are always allowed."""
+    limiter = LIMITERS.get(endpoint)
+    return limiter is None or limiter.allow(subject)
+
+
+def get_stats():
+    """Returns the shared allowed and dropped counts of every limiter"""
+    keys = [MEMCACHE_STATS.format(name, kind) for name in sorted(LIMITERS)
+            for kind in ('allowed', 'dropped')]
+    counts = memcache.get_multi(keys)
+    stats = {}
+    for name in sorted(LIMITERS):
+        stats[name] = dict(
+            (kind, int(counts.get(MEMCACHE_STATS.format(name, kind), 0)))
+            for kind in ('allowed', 'dropped'))
+    return stats
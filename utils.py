@@ -1,23 +1,34 @@
 """utils.py - File for collecting general utility functions."""
 
 import random
+import re
+import time
 from google.appengine.ext import ndb
 import endpoints
 
+CARD_SUITS = ['H', 'D', 'S', 'C']  # Heart, Diamond, Spade, Club
+CARD_RANKS = ['2', '3', '4', '5', '6', '7', '8', '9',
+              '10', 'J', 'Q', 'K', 'A']
+# Both lookup tables are built once at import (and so during warmup) instead
+# of on every deal and every hand evaluation.
+DECK = [suit + rank for suit in CARD_SUITS for rank in CARD_RANKS]
+# Card value with aces counted as 1; calc_val upgrades aces to 11 itself.
+CARD_VALUES = dict((suit + rank,
+                    1 if rank == 'A' else 10 if rank in 'JQK' else int(rank))
+                   for suit in CARD_SUITS for rank in CARD_RANKS)
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that the urlsafe key string points to without
+        fetching the entity. Raises an error if the key String is malformed
+        or the key is of the incorrect kind
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The Key that the urlsafe Key string points to.
     Raises:
-        ValueError:"""
+        BadRequestException:"""
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -28,58 +39,102 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity
+    if key.kind() != model._get_kind():
+        raise endpoints.BadRequestException('Incorrect Kind')
+    return key
 
 
-def create_deck():
-    """Creates a deck and shuffles it."""
-    cards = []
-    card_suits = ['H', 'D', 'S', 'C']  # Heart, Diamond, Spade, Club
-    card_ranks = ['2', '3', '4', '5', '6', '7', '8', '9',
-                  '10', 'J', 'Q', 'K', 'A']
-    for suit in card_suits:
-        for rank in card_ranks:
-            cards.append(suit + rank)
+def get_by_urlsafe(urlsafe, model):
+    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+        that the type of entity returned is of the correct kind. Raises an
+        error if the key String is malformed or the entity is of the incorrect
+        kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        BadRequestException:"""
+    return get_key_by_urlsafe(urlsafe, model).get()
+
+
+def parse_fields(fields, form):
+    """Parses a comma separated fields mask for a response form.
+    Args:
+        fields: The fields request parameter, may be None
+        form: The protorpc Message class the mask applies to
+    Returns:
+        A frozenset of field names, or None if no mask was given.
+    Raises:
+        BadRequestException: if a field is not part of the form."""
+    if not fields:
+        return None
+    names = frozenset(name.strip() for name in fields.split(',')
+                      if name.strip())
+    unknown = [name for name in names
+               if name not in [field.name for field in form.all_fields()]]
+    if unknown:
+        raise endpoints.BadRequestException(
+            'Unknown fields: {}'.format(', '.join(sorted(unknown))))
+    return names
 
+
+def create_deck(decks=1):
+    """Creates a deck, or a shoe of several decks, and shuffles it."""
+    cards = DECK * decks
     random.shuffle(cards)
     return cards
 
 
 def get_card_val(card, bigA=False):
     """Given a card, find its value. if bigA is True, evaluate aces as 11."""
-    if len(card) == 3:
-        rank = card[1] + card[2]
-    else:
-        rank = card[1]
-    if rank in 'A':
-        if bigA:
-            return 11
-        else:
-            return 1
-    elif rank in 'JQK':
-        return 10
-    else:
-        return int(rank)
+    if bigA and card[1] == 'A':
+        return 11
+    return CARD_VALUES[card]
 
 
 def calc_val(cards):
     """Given an array of cards, find the value of the array.
        Will try to evaluate aces intelligently."""
     value = 0
-    aces = []  # going to evaluate aces at the end.
+    aces = 0  # going to evaluate aces at the end.
     for card in cards:
         if card[1] == 'A':
-            aces.append(card)
+            aces += 1
         else:
-            value += get_card_val(card)
-    for ace in aces:
+            value += CARD_VALUES[card]
+    for ace in range(aces):
         if value <= 10:
-            value += get_card_val(ace, True)
+            value += 11
         else:
-            value += get_card_val(ace)
+            value += 1
     return value
+
+
+def enqueue_coalesced(url, window=60, queue_name='default'):
+    """Schedules a task for url at most once per time window.
+        The task is named after the url and the current window, so any
+        further enqueue in the same window is rejected by the task queue as a
+        duplicate. The task runs at the end of its window, after every
+        request that asked for it. The add is asynchronous and its result is
+        never waited on, so the caller pays no latency for it.
+    Args:
+        url: The task handler url
+        window: Length of the coalescing window in seconds
+        queue_name: The queue to add the task to
+    Returns:
+        The asynchronous RPC of the add."""
+    # Only new_game schedules tasks, so keep the import off the cold start.
+    from google.appengine.api import taskqueue
+    now = time.time()
+    bucket = int(now // window)
+    name = '{}-{}'.format(re.sub(r'[^a-zA-Z0-9_-]', '-', url.strip('/')),
+                          bucket)
+    task = taskqueue.Task(name=name, url=url,
+                          countdown=(bucket + 1) * window - now)
+    # A duplicate name raises TaskAlreadyExistsError or TombstonedTaskError
+    # when the RPC completes. Both mean the work is already scheduled, so the
+    # RPC is deliberately left unchecked.
+    return taskqueue.Queue(queue_name).add_async(task)